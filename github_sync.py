@@ -8,13 +8,20 @@ import os
 import sys
 import json
 import base64
+import gzip
 import hashlib
+import mmap
+import sqlite3
 import logging
+import time
 import argparse
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
+from email.utils import parsedate_to_datetime
 from typing import Optional
-import requests
 
 # ── Logging ────────────────────────────────────────────────────────────────────
 LOG_FILE = Path(__file__).parent / "sync.log"
@@ -53,6 +60,8 @@ DEFAULT_CONFIG = {
         "venv", "env", ".idea", ".vscode", "dist", "build",
     ],
     "max_file_size_mb": 10,      # Skip files larger than this
+    "max_workers": 6,            # Parallel uploads (keep low to avoid abuse limits)
+    "mmap_threshold_kb": 1024,   # Smaller files are read once and kept for upload; larger ones memory-mapped
     "dry_run": False,            # Set True to preview without uploading
 }
 
@@ -73,10 +82,45 @@ def save_config(cfg: dict):
 
 
 # ── GitHub API helpers ─────────────────────────────────────────────────────────
+def _int_header(r, name: str) -> Optional[int]:
+    try:
+        return int(r.headers[name])
+    except (KeyError, ValueError):
+        return None
+
+
+def _retry_after(r) -> Optional[float]:
+    """Parse Retry-After in either its seconds or HTTP-date form; None if absent or garbled."""
+    value = r.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
 class GitHubAPI:
     BASE = "https://api.github.com"
+    GZIP_MIN_BYTES = 1024   # Smaller bodies aren't worth compressing
+    RATE_LIMIT_RETRIES = 5   # Attempts after a 403/429 rate-limit response
+    RATE_LIMIT_FLOOR = 50    # Start pacing calls when fewer than this remain
 
     def __init__(self, token: str, username: str, repo: str, branch: str):
+        # Imported here so --setup, --help and no-op runs skip the cost
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        try:
+            import orjson   # Optional: much faster serialisation of large upload bodies
+            self.dumps = orjson.dumps
+        except ImportError:
+            self.dumps = lambda obj: json.dumps(obj).encode()
+
         self.headers = {
             "Authorization": f"token {token}",
             "Accept": "application/vnd.github+json",
@@ -86,44 +130,167 @@ class GitHubAPI:
         self.repo = repo
         self.branch = branch
 
+        # One keep-alive pool shared by all worker threads instead of a fresh
+        # TLS handshake per call.
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=16,
+            max_retries=Retry(
+                total=5,
+                backoff_factor=0.5,
+                status_forcelist=[502, 503, 504],   # 429/403 are handled by _request
+                raise_on_status=False,
+            ),
+        )
+        self.session.mount("https://", adapter)
+        self.gzip_bodies = True
+
     def _url(self, path: str) -> str:
         return f"{self.BASE}{path}"
 
-    def get_file_sha(self, repo_path: str) -> Optional[str]:
-        """Return the SHA of an existing file, or None if it doesn't exist."""
-        url = self._url(f"/repos/{self.username}/{self.repo}/contents/{repo_path}")
-        r = requests.get(url, headers=self.headers, params={"ref": self.branch})
+    def _request(self, method: str, url: str, **kwargs):
+        """Send a request, waiting out primary and secondary rate limits."""
+        for attempt in range(self.RATE_LIMIT_RETRIES + 1):
+            r = self.session.request(method, url, **kwargs)
+            wait = self._rate_limit_wait(r, attempt)
+            if wait is None or attempt == self.RATE_LIMIT_RETRIES:
+                break
+            log.warning("Rate limited (%s) — retrying in %.0fs", r.status_code, wait)
+            time.sleep(wait)
+
+        # Spread the remaining quota over the time left until it resets
+        # rather than running into the wall.
+        remaining = _int_header(r, "X-RateLimit-Remaining")
+        reset = _int_header(r, "X-RateLimit-Reset")
+        if remaining and reset and remaining < self.RATE_LIMIT_FLOOR:
+            time.sleep(max(0, reset - time.time()) / remaining)
+        return r
+
+    @staticmethod
+    def _rate_limit_wait(r, attempt: int) -> Optional[float]:
+        """Seconds to wait before retrying `r`, or None if it wasn't rate limited."""
+        if r.status_code not in (403, 429):
+            return None
+        retry_after = _retry_after(r)
+        if retry_after is not None:
+            return retry_after
+        reset = _int_header(r, "X-RateLimit-Reset")
+        if _int_header(r, "X-RateLimit-Remaining") == 0 and reset:
+            return max(1, reset - time.time() + 1)
+        if r.status_code == 429 or "rate limit" in r.text.lower():
+            # Secondary limit without guidance: GitHub asks for at least a minute
+            return 60 * 2 ** attempt
+        return None   # A plain 403 is a permissions problem; don't retry
+
+    def _post_json(self, url: str, payload: dict, compress: bool = False):
+        """POST `payload` as JSON, gzip-compressed when asked and still accepted."""
+        body = self.dumps(payload)
+        headers = {"Content-Type": "application/json"}
+        if compress and self.gzip_bodies:
+            r = self._request(
+                "POST", url, data=gzip.compress(body, compresslevel=6),
+                headers={**headers, "Content-Encoding": "gzip"},
+            )
+            if r.status_code not in (400, 415):
+                return r
+            log.warning("Server rejected a gzip request body — sending uncompressed from now on")
+            self.gzip_bodies = False
+        return self._request("POST", url, data=body, headers=headers)
+
+    def _git_url(self, path: str) -> str:
+        return self._url(f"/repos/{self.username}/{self.repo}/git{path}")
+
+    def get_ref_sha(self) -> Optional[str]:
+        """Return the commit SHA the branch points at, or None if it doesn't exist."""
+        r = self._request("GET", self._git_url(f"/ref/heads/{self.branch}"))
         if r.status_code == 200:
-            return r.json().get("sha")
+            return r.json()["object"]["sha"]
+        log.error("Could not read branch %s — %s: %s", self.branch, r.status_code, r.text[:200])
         return None
 
-    def put_file(self, repo_path: str, content_bytes: bytes, message: str, sha: Optional[str] = None) -> bool:
-        """Create or update a file. Returns True on success."""
-        url = self._url(f"/repos/{self.username}/{self.repo}/contents/{repo_path}")
-        payload = {
-            "message": message,
-            "content": base64.b64encode(content_bytes).decode(),
-            "branch": self.branch,
-        }
-        if sha:
-            payload["sha"] = sha
-        r = requests.put(url, headers=self.headers, json=payload)
-        if r.status_code in (200, 201):
+    def get_tree_sha(self, commit_sha: str) -> Optional[str]:
+        """Return the root tree SHA of a commit."""
+        r = self._request("GET", self._git_url(f"/commits/{commit_sha}"))
+        if r.status_code == 200:
+            return r.json()["tree"]["sha"]
+        log.error("Could not read commit %s — %s: %s", commit_sha, r.status_code, r.text[:200])
+        return None
+
+    def create_blob(self, content: str, encoding: str = "base64") -> Optional[str]:
+        """Upload file contents ("base64" or "utf-8" encoded) as a blob. Returns the blob SHA."""
+        payload = {"content": content, "encoding": encoding}
+        r = self._post_json(self._git_url("/blobs"), payload, compress=len(content) >= self.GZIP_MIN_BYTES)
+        if r.status_code == 201:
+            return r.json()["sha"]
+        log.error("Failed to create blob — %s: %s", r.status_code, r.text[:200])
+        return None
+
+    def create_tree(self, base_tree_sha: str, entries: list) -> Optional[str]:
+        """Create a tree layering `entries` on top of `base_tree_sha`."""
+        payload = {"base_tree": base_tree_sha, "tree": entries}
+        r = self._post_json(self._git_url("/trees"), payload)
+        if r.status_code == 201:
+            return r.json()["sha"]
+        log.error("Failed to create tree — %s: %s", r.status_code, r.text[:200])
+        return None
+
+    def create_commit(self, parent_sha: str, tree_sha: str, message: str) -> Optional[str]:
+        """Create a commit object. Returns the commit SHA."""
+        payload = {"message": message, "tree": tree_sha, "parents": [parent_sha]}
+        r = self._post_json(self._git_url("/commits"), payload)
+        if r.status_code == 201:
+            return r.json()["sha"]
+        log.error("Failed to create commit — %s: %s", r.status_code, r.text[:200])
+        return None
+
+    def update_ref(self, commit_sha: str) -> bool:
+        """Fast-forward the branch to `commit_sha`. Returns True on success."""
+        r = self._request("PATCH", self._git_url(f"/refs/heads/{self.branch}"), json={"sha": commit_sha})
+        if r.status_code == 200:
             return True
-        log.error("Failed to upload %s — %s: %s", repo_path, r.status_code, r.text[:200])
+        log.error("Failed to update %s — %s: %s", self.branch, r.status_code, r.text[:200])
         return False
 
+    def graphql(self, query: str, variables: dict) -> Optional[dict]:
+        """Run a GraphQL query/mutation. Returns its `data`, or None on any error."""
+        payload = {"query": query, "variables": variables}
+        r = self._post_json(self._url("/graphql"), payload, compress=True)
+        if r.status_code == 200 and not r.json().get("errors"):
+            return r.json()["data"]
+        log.error("GraphQL request failed — %s: %s", r.status_code, r.text[:200])
+        return None
+
+    def commit_files(self, head_sha: str, additions: list, message: str) -> Optional[str]:
+        """Commit `additions` ({path, contents(base64)}) on top of `head_sha` in one request.
+
+        GitHub rejects the commit if the branch has moved past `head_sha`.
+        Returns the new commit SHA.
+        """
+        mutation = """
+            mutation($input: CreateCommitOnBranchInput!) {
+              createCommitOnBranch(input: $input) { commit { oid } }
+            }"""
+        data = self.graphql(mutation, {"input": {
+            "branch": {"repositoryNameWithOwner": f"{self.username}/{self.repo}", "branchName": self.branch},
+            "expectedHeadOid": head_sha,
+            "message": {"headline": message},
+            "fileChanges": {"additions": additions},
+        }})
+        return data and data["createCommitOnBranch"]["commit"]["oid"]
+
     def ensure_repo_exists(self) -> bool:
         """Check that the repo is accessible."""
         url = self._url(f"/repos/{self.username}/{self.repo}")
-        r = requests.get(url, headers=self.headers)
+        r = self._request("GET", url)
         return r.status_code == 200
 
     def create_repo(self, private: bool = False) -> bool:
         """Create the repository if it doesn't exist."""
         url = self._url("/user/repos")
         payload = {"name": self.repo, "private": private, "auto_init": True}
-        r = requests.post(url, headers=self.headers, json=payload)
+        r = self._request("POST", url, json=payload)
         if r.status_code == 201:
             log.info("Created new repo: %s/%s", self.username, self.repo)
             return True
@@ -133,38 +300,402 @@ class GitHubAPI:
 
 # ── Local file discovery ───────────────────────────────────────────────────────
 def collect_files(library_path: Path, extensions: list, ignore_dirs: list, max_mb: float):
-    """Yield (abs_path, relative_repo_path) for all matching files."""
-    exts = {e.lower() for e in extensions} if extensions else None
+    """Yield (abs_path, relative_repo_path, stat) for all matching files."""
+    exts = frozenset(e.lstrip(".").lower() for e in extensions) if extensions else None
     ignore = set(ignore_dirs)
-    ignore_files = {"config.json", ".sync_cache.json", "sync.log"}
+    ignore_files = {
+        "config.json", "sync.log", ".sync_cache.json",
+        ".sync_cache.sqlite", ".sync_cache.sqlite-wal", ".sync_cache.sqlite-shm",
+    }
     max_bytes = int(max_mb * 1024 * 1024)
+    prefix_len = len(os.path.join(str(library_path), ""))
+
+    # Explicit scandir walk: DirEntry carries the file type, and the stat we
+    # take here is handed on so run_sync never stats the file again.
+    stack = [str(library_path)]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                name = entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if name not in ignore:
+                        stack.append(entry.path)
+                    continue
+                if not entry.is_file() or name in ignore_files:
+                    continue
+                if exts:
+                    dot = name.rfind(".")
+                    # dot == 0 is a dotfile like ".bashrc", which has no suffix
+                    if dot <= 0 or name[dot + 1:].lower() not in exts:
+                        continue
+                try:
+                    st = entry.stat()
+                except OSError:   # Removed since the directory was listed
+                    continue
+                if st.st_size > max_bytes:
+                    log.warning("Skipping large file: %s", entry.path)
+                    continue
+                rel = entry.path[prefix_len:]
+                yield entry.path, rel.replace("\\", "/"), st   # GitHub paths use /
+
+
+CHUNK = 3 << 18            # 768 KiB: a multiple of 3, so base64 chunks concatenate
+MMAP_THRESHOLD = 1 << 20   # Default size from which files are memory-mapped instead
+
+
+def buffer_hash(data) -> str:
+    """Digest used only for local change detection against the sync cache."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def file_hash(path, size: int, mmap_threshold: int = MMAP_THRESHOLD) -> str:
+    """Digest of a file, without building an upload body."""
+    if size == 0 or size < mmap_threshold:
+        with open(path, "rb") as f:
+            return buffer_hash(f.read())
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return buffer_hash(mm)
+
+
+def encode_body(data: bytes):
+    """Return (body, encoding) for a blob upload.
+
+    Text files come back as-is with encoding "utf-8", sparing them base64's
+    4/3 inflation; everything else is base64-encoded.
+    """
+    if b"\x00" not in data:
+        try:
+            return data.decode("utf-8"), "utf-8"
+        except UnicodeDecodeError:
+            pass
+    return base64.b64encode(data).decode(), "base64"
+
+
+def file_hash_and_body(path, size: int, mmap_threshold: int = MMAP_THRESHOLD):
+    """Return (digest, body, encoding) for a file from a single pass over its bytes."""
+    # Small files: one read, and the same buffer is hashed and becomes the body
+    if size == 0 or size < mmap_threshold:
+        with open(path, "rb") as f:
+            data = f.read()
+        return (buffer_hash(data), *encode_body(data))
+
+    # Large files: walk the mapping once, feeding each slice to both the hash
+    # and the encoder while it is still hot in cache.
+    h = hashlib.blake2b(digest_size=16)
+    out = bytearray()
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        with memoryview(mm) as mv:
+            for i in range(0, len(mm), CHUNK):
+                with mv[i:i + CHUNK] as chunk:
+                    h.update(chunk)
+                    out += base64.b64encode(chunk)
+    return h.hexdigest(), out.decode(), "base64"
+
+
+# ── Sync cache ─────────────────────────────────────────────────────────────────
+CACHE_FILE = Path(__file__).parent / ".sync_cache.sqlite"
+CACHE_VERSION = 2   # Bump whenever the digest or entry layout changes
+CACHE_COLUMNS = ("hash", "size", "mtime_ns")
+
+
+def open_cache(path: Path) -> sqlite3.Connection:
+    """Open the cache database, wiping it if it was written by another version."""
+    db = sqlite3.connect(path, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    if db.execute("PRAGMA user_version").fetchone()[0] != CACHE_VERSION:
+        db.execute("DROP TABLE IF EXISTS files")
+        db.execute(f"PRAGMA user_version = {CACHE_VERSION}")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS files ("
+        "repo_path TEXT PRIMARY KEY, hash TEXT, size INTEGER, mtime_ns INTEGER)"
+    )
+    return db
 
-    for root, dirs, files in os.walk(library_path):
-        # Prune ignored directories in-place
-        dirs[:] = [d for d in dirs if d not in ignore]
 
-        for fname in files:
-            if fname in ignore_files:
-                continue
-            if exts and Path(fname).suffix.lower() not in exts:
+def load_cache(db: sqlite3.Connection) -> dict:
+    """Read every entry in one query, as {repo_path: {hash, size, mtime_ns}}."""
+    rows = db.execute("SELECT repo_path, hash, size, mtime_ns FROM files")
+    return {row[0]: dict(zip(CACHE_COLUMNS, row[1:])) for row in rows}
+
+
+def save_cache(db: sqlite3.Connection, entries: dict):
+    """Upsert only the given entries; untouched rows are never rewritten."""
+    db.execute("BEGIN")
+    db.executemany(
+        "INSERT OR REPLACE INTO files (repo_path, hash, size, mtime_ns) VALUES (?, ?, ?, ?)",
+        [(path, *(e.get(c) for c in CACHE_COLUMNS)) for path, e in entries.items()],
+    )
+    db.execute("COMMIT")
+
+
+def peek_cache(path: Path) -> dict:
+    """Read the cache without creating, migrating or locking anything (for dry runs)."""
+    if not path.exists():
+        return {}
+    # immutable=1 also stops SQLite from creating -wal/-shm files next to it
+    db = sqlite3.connect(f"{path.resolve().as_uri()}?mode=ro&immutable=1", uri=True)
+    try:
+        if db.execute("PRAGMA user_version").fetchone()[0] == CACHE_VERSION:
+            return load_cache(db)
+    except sqlite3.Error:
+        pass
+    finally:
+        db.close()
+    return {}
+
+
+# ── Main sync logic ────────────────────────────────────────────────────────────
+
+
+def _hash_one(abs_path: str, repo_path: str, st: os.stat_result, cache: dict, mmap_threshold: int) -> dict:
+    """Decide whether a file changed since the last sync. Runs in a hashing thread."""
+    result = {
+        "abs_path": abs_path, "repo_path": repo_path, "status": "changed",
+        "size": st.st_size, "mtime_ns": st.st_mtime_ns,
+    }
+    entry = cache.get(repo_path, {})
+    # Same size and mtime as last sync: trust it's unchanged and skip hashing
+    if (entry.get("size"), entry.get("mtime_ns")) == (st.st_size, st.st_mtime_ns):
+        result["status"] = "skipped"
+        return result
+
+    # Small files are read once and the same buffer becomes the upload body.
+    # Memory-mapped files only get their digest here; the upload stage builds
+    # their body, so the queue between the stages never holds large contents.
+    data = None
+    if st.st_size == 0 or st.st_size < mmap_threshold:
+        with open(abs_path, "rb") as f:
+            data = f.read()
+        result["hash"] = buffer_hash(data)
+    else:
+        result["hash"] = file_hash(abs_path, st.st_size, mmap_threshold)
+
+    # Content unchanged, only the mtime moved
+    if entry.get("hash") == result["hash"]:
+        result["status"] = "skipped"
+        result["touched"] = True
+    elif data is not None:
+        result["body"], result["encoding"] = encode_body(data)
+    return result
+
+
+def _upload_one(result: dict, api: GitHubAPI) -> dict:
+    """Upload a changed file as a blob. Runs in an upload thread."""
+    result["status"] = "uploaded"
+    result["sha"] = api.create_blob(result.pop("body"), result["encoding"])
+    if result["sha"] is None:
+        log.error("Failed to upload %s", result["repo_path"])
+        result["status"] = "failed"
+    return result
+
+
+PIPELINE_DEPTH = 32   # Max files waiting between stages; bounds work in flight
+GRAPHQL_MAX_BYTES = 20 << 20   # Encoded content sent in one GraphQL commit at most
+_DONE = object()      # Queue sentinel
+
+
+def _start(target, count: int = 1) -> list:
+    threads = [threading.Thread(target=target, daemon=True) for _ in range(count)]
+    for t in threads:
+        t.start()
+    return threads
+
+
+def _pipeline(files, cache: dict, get_api, cfg: dict):
+    """Yield one result dict per file while scanning, hashing and uploading overlap.
+
+    scanner -> [paths] -> hash workers -> [changed] -> upload workers -> [results]
+
+    Changed files are held back (no network at all) while their encoded size
+    fits in one GraphQL commit; they come out last with "sha" unset. Once
+    the budget is exceeded, everything held is flushed as blobs and the rest
+    of the run uploads blobs as files arrive.
+    """
+    paths = queue.Queue(PIPELINE_DEPTH)
+    changed = queue.Queue(PIPELINE_DEPTH)
+    results = queue.Queue()
+    n_hash = os.cpu_count() or 1
+    n_upload = max(1, int(cfg.get("max_workers", 6)))   # 0 would leave nothing draining `changed`
+    mmap_threshold = int(cfg.get("mmap_threshold_kb", 1024) * 1024)
+
+    def failed(repo_path: str, reason) -> dict:
+        log.error("Failed to sync %s — %s", repo_path, reason)
+        return {"repo_path": repo_path, "status": "failed"}
+
+    def scan():
+        try:
+            for item in files:
+                paths.put(item)
+        except Exception as e:
+            log.error("Scanning stopped early — %s", e)
+        finally:
+            for _ in range(n_hash):
+                paths.put(_DONE)
+
+    def hash_worker():
+        # hashlib releases the GIL on large buffers, so these scale across cores
+        while True:
+            item = paths.get()
+            if item is _DONE:
+                return
+            # Any error must become a result: a dead worker would stall the queues
+            try:
+                result = _hash_one(*item, cache, mmap_threshold)
+            except Exception as e:
+                result = failed(item[1], e)
+            (changed if result["status"] == "changed" else results).put(result)
+
+    held = []
+    flushed = queue.Queue()   # Held files released once the GraphQL budget overflows
+    budget = {"bytes": 0, "open": True}
+    held_lock = threading.Lock()
+
+    def upload(result: dict) -> dict:
+        try:
+            api = get_api()
+            if api is None:
+                return failed(result["repo_path"], "repository unavailable")
+            return _upload_one(result, api)
+        except Exception as e:   # A dead worker would stall the queues
+            return failed(result["repo_path"], e)
+
+    def next_flushed() -> Optional[dict]:
+        try:
+            return flushed.get_nowait()
+        except queue.Empty:
+            return None
+
+    def upload_worker():
+        while True:
+            # Files released by a budget overflow go first, spread over all workers
+            item = next_flushed()
+            if item is not None:
+                results.put(upload(item))
                 continue
-            abs_path = Path(root) / fname
-            if abs_path.stat().st_size > max_bytes:
-                log.warning("Skipping large file: %s", abs_path)
+            result = changed.get()
+            if result is _DONE:
+                item = next_flushed()
+                while item is not None:
+                    results.put(upload(item))
+                    item = next_flushed()
+                return
+            if cfg["dry_run"]:
+                log.info("[DRY-RUN] Would upload: %s", result["repo_path"])
+                result["status"] = "uploaded"
+                results.put(result)
                 continue
-            rel = abs_path.relative_to(library_path)
-            yield abs_path, str(rel).replace("\\", "/")   # GitHub paths use /
+            if "body" not in result:
+                # Memory-mapped file: read and encode it in one pass now. The
+                # fresh digest is what gets cached, in case the file changed
+                # again since it was hashed.
+                try:
+                    result["hash"], result["body"], result["encoding"] = file_hash_and_body(
+                        result["abs_path"], result["size"], mmap_threshold
+                    )
+                except Exception as e:
+                    results.put(failed(result["repo_path"], e))
+                    continue
+            with held_lock:
+                if budget["open"]:
+                    # GraphQL only takes base64, whatever the file's encoding
+                    b64_len = (result["size"] + 2) // 3 * 4
+                    if budget["bytes"] + b64_len <= GRAPHQL_MAX_BYTES:
+                        budget["bytes"] += b64_len
+                        held.append(result)
+                        continue
+                    # Too much for one request: switch to blobs for everything
+                    budget["open"] = False
+                    for item in held:
+                        flushed.put(item)
+                    held.clear()
+            results.put(upload(result))
+
+    hashers = _start(hash_worker, n_hash)
+    uploaders = _start(upload_worker, n_upload)
+    _start(scan)
+
+    def close():
+        # However the stages end, run_sync must get its _DONE
+        try:
+            for t in hashers:
+                t.join()
+            for _ in uploaders:
+                changed.put(_DONE)
+            for t in uploaders:
+                t.join()
+            for result in held:
+                result["status"] = "uploaded"
+                result["sha"] = None
+                results.put(result)
+        finally:
+            results.put(_DONE)
+    _start(close)
+
+    while True:
+        result = results.get()
+        if result is _DONE:
+            return
+        yield result
+
+
+def _connect(cfg: dict) -> Optional[GitHubAPI]:
+    """Build the API client and make sure the target repo exists."""
+    api = GitHubAPI(cfg["github_token"], cfg["github_username"], cfg["repo_name"], cfg["branch"])
+    if not api.ensure_repo_exists():
+        log.warning("Repo not found — attempting to create it...")
+        if not api.create_repo():
+            log.error("Cannot access or create repo. Check your token and repo name.")
+            return None
+    return api
 
 
-def file_md5(path: Path) -> str:
-    h = hashlib.md5()
-    with open(path, "rb") as f:
-        for chunk in iter(lambda: f.read(65536), b""):
-            h.update(chunk)
-    return h.hexdigest()
+def _as_base64(result: dict) -> str:
+    if result["encoding"] == "base64":
+        return result["body"]
+    return base64.b64encode(result["body"].encode("utf-8")).decode()
+
+
+def _commit_changes(api: GitHubAPI, uploaded: list, commit_msg: str, max_workers: int) -> bool:
+    """Commit every uploaded file to the branch as one commit."""
+    held = [res for res in uploaded if res["sha"] is None]
+    if held:
+        head = api.get_ref_sha()
+        if head is None:
+            return False
+        additions = [{"path": res["repo_path"], "contents": _as_base64(res)} for res in held]
+        if api.commit_files(head, additions, commit_msg):
+            return True
+        log.warning("Single-request commit failed — retrying via blob uploads")
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                if not all(res["sha"] for res in pool.map(lambda res: _upload_one(res, api), held)):
+                    return False
+        except OSError as e:   # includes requests' exceptions
+            log.error("Blob upload failed — %s", e)
+            return False
+    return _commit_blobs(api, uploaded, commit_msg)
+
+
+def _commit_blobs(api: GitHubAPI, uploaded: list, commit_msg: str) -> bool:
+    """Point the branch at a single new commit containing all uploaded blobs."""
+    parent = api.get_ref_sha()
+    base_tree = parent and api.get_tree_sha(parent)
+    if not base_tree:
+        return False
+    entries = [
+        {"path": res["repo_path"], "mode": "100644", "type": "blob", "sha": res["sha"]}
+        for res in uploaded
+    ]
+    tree = api.create_tree(base_tree, entries)
+    commit = tree and api.create_commit(parent, tree, commit_msg)
+    return bool(commit) and api.update_ref(commit)
 
 
-# ── Main sync logic ────────────────────────────────────────────────────────────
 def run_sync(cfg: dict) -> dict:
     stats = {"uploaded": 0, "skipped": 0, "failed": 0, "total": 0}
     date_str = datetime.now().strftime("%Y-%m-%d %H:%M")
@@ -181,52 +712,76 @@ def run_sync(cfg: dict) -> dict:
         log.error("Library path does not exist: %s", library)
         sys.exit(1)
 
-    api = GitHubAPI(cfg["github_token"], cfg["github_username"], cfg["repo_name"], cfg["branch"])
+    # Connect (and check the repo) only once a file actually needs uploading,
+    # so runs where nothing changed never touch the network.
+    api_lock = threading.Lock()
+    api_state: dict = {}
 
-    # Ensure repo exists
-    if not api.ensure_repo_exists():
-        log.warning("Repo not found — attempting to create it...")
-        if not api.create_repo():
-            log.error("Cannot access or create repo. Check your token and repo name.")
-            sys.exit(1)
+    def get_api() -> Optional[GitHubAPI]:
+        with api_lock:
+            if "api" not in api_state:
+                api_state["api"] = _connect(cfg)
+            return api_state["api"]
 
     log.info("Starting sync: %s -> %s/%s @ %s", library, cfg["github_username"], cfg["repo_name"], cfg["branch"])
 
-    cache_file = Path(__file__).parent / ".sync_cache.json"
-    cache: dict = json.loads(cache_file.read_text()) if cache_file.exists() else {}
+    if cfg["dry_run"]:
+        # A preview must leave the cache exactly as it found it
+        db = None
+        cache = peek_cache(CACHE_FILE)
+    else:
+        db = open_cache(CACHE_FILE)
+        cache = load_cache(db)
 
-    for abs_path, repo_path in collect_files(library, cfg["extensions"], cfg["ignore_dirs"], cfg["max_file_size_mb"]):
+    dirty = {}   # Entries to write back at the end
+    uploaded = []
+    files = collect_files(library, cfg["extensions"], cfg["ignore_dirs"], cfg["max_file_size_mb"])
+    for result in _pipeline(files, cache, get_api, cfg):
         stats["total"] += 1
-        md5 = file_md5(abs_path)
-
-        # Skip if file hasn't changed since last sync
-        if cache.get(repo_path) == md5:
-            stats["skipped"] += 1
-            continue
-
+        stats[result["status"]] += 1
         if cfg["dry_run"]:
-            log.info("[DRY-RUN] Would upload: %s", repo_path)
-            stats["uploaded"] += 1
             continue
-
-        sha = api.get_file_sha(repo_path)
-        content = abs_path.read_bytes()
-
-        if api.put_file(repo_path, content, commit_msg, sha=sha):
-            log.info("OK  %s", repo_path)
-            cache[repo_path] = md5
-            stats["uploaded"] += 1
+        if result["status"] == "uploaded":
+            uploaded.append(result)
+        elif result.get("touched"):
+            # Record the new stat so the next run can skip hashing it
+            entry = cache[result["repo_path"]]
+            entry.update(size=result["size"], mtime_ns=result["mtime_ns"])
+            dirty[result["repo_path"]] = entry
+
+    # All changed files land in one commit (a single GraphQL request when they
+    # fit); the cache is only updated once the branch actually points at it.
+    if uploaded:
+        workers = max(1, int(cfg.get("max_workers", 6)))
+        try:
+            api = get_api()
+            committed = bool(api) and _commit_changes(api, uploaded, commit_msg, workers)
+        except Exception as e:   # includes requests' connection errors
+            log.error("Commit failed — %s", e)
+            committed = False
+        if committed:
+            for res in uploaded:
+                log.info("OK  %s", res["repo_path"])
+                dirty[res["repo_path"]] = {c: res[c] for c in CACHE_COLUMNS}
         else:
-            stats["failed"] += 1
+            log.error("Commit failed — %d file(s) not synced", len(uploaded))
+            stats["uploaded"] -= len(uploaded)
+            stats["failed"] += len(uploaded)
 
-    # Persist cache
-    if not cfg["dry_run"]:
-        cache_file.write_text(json.dumps(cache, indent=2))
+    if not stats["uploaded"] and not stats["failed"]:
+        log.info("Nothing to upload — repository not contacted")
+
+    if db is not None:
+        if dirty:
+            save_cache(db, dirty)
+        db.close()
 
     log.info(
         "Sync complete — %d uploaded, %d skipped (unchanged), %d failed, %d total",
         stats["uploaded"], stats["skipped"], stats["failed"], stats["total"],
     )
+    if "api" in api_state and api_state["api"] is None:
+        sys.exit(1)
     return stats
 
 